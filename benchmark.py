@@ -0,0 +1,290 @@
+"""Офлайн-бенчмарк Maximoy: синтетические данные + фейковый транспорт Telegram.
+
+Запуск:
+    python benchmark.py --users 10000 --habits-per-user 5 --progress-days 20
+
+Ни одного запроса в сеть: Bot работает поверх FakeRequest, который
+записывает вызовы API и возвращает правдоподобные ответы.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import random
+import resource
+import shutil
+import statistics
+import tempfile
+import sys
+import time
+from unittest import mock
+
+from telegram import Bot, Chat, Message, Update, User
+from telegram.request import BaseRequest
+
+import bot as maximoy
+
+FAKE_TOKEN = "123456:BENCHMARK"
+CHAT_ID = 1000
+
+
+class FakeRequest(BaseRequest):
+    """Транспорт, который вместо HTTP записывает вызовы Bot API"""
+    def __init__(self):
+        self.calls = []
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append(endpoint)
+
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Maximoy", "username": "maximoy_bot"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", CHAT_ID), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса: включает загруженный датасет и кеши хранилища"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class FakeContext:
+    """Минимальный контекст: обработчики используют только user_data и bot"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.user_data = {}
+
+
+def make_update(bot, user_id, text, update_id=1):
+    user = User(id=user_id, first_name="Bench", is_bot=False)
+    message = Message(
+        message_id=update_id,
+        date=datetime.datetime.now(),
+        chat=Chat(id=user_id, type="private"),
+        from_user=user,
+        text=text,
+    )
+    message.set_bot(bot)
+    return Update(update_id=update_id, message=message)
+
+
+def generate_dataset(storage, users, habits_per_user, tasks_per_user, progress_days, moods_per_user):
+    """Записывает синтетические данные напрямую в файлы хранилища"""
+    now = datetime.datetime.now()
+    habits, tasks, mood = {}, {}, {}
+    next_id = int(now.timestamp() * 1000)
+
+    for user_id in range(1, users + 1):
+        for _ in range(habits_per_user):
+            next_id += 1
+            progress = {}
+            for day in range(progress_days):
+                date = now - datetime.timedelta(days=day)
+                progress[date.strftime("%Y-%m-%d")] = {"completed": True, "timestamp": date.isoformat()}
+            habits[str(next_id)] = {
+                "user_id": user_id,
+                "name": random.choice(["Зарядка", "Чтение книги", "Медитация", "Бег", "Английский"]),
+                "description": "",
+                "category": random.choice(["Здоровье", "Учеба", "Спорт", "Отдых"]),
+                "difficulty": "medium",
+                "streak": progress_days,
+                "best_streak": progress_days,
+                "total_completed": progress_days,
+                "created_date": now.isoformat(),
+                "progress": progress,
+            }
+        for i in range(tasks_per_user):
+            next_id += 1
+            tasks[str(next_id)] = {
+                "user_id": user_id,
+                "title": f"Задача {i}",
+                "description": "",
+                "priority": random.choice(["high", "medium", "low"]),
+                "due_date": None,
+                "completed": random.random() < 0.5,
+                "created_date": now.isoformat(),
+            }
+        for _ in range(moods_per_user):
+            next_id += 1
+            mood[str(next_id)] = {
+                "user_id": user_id,
+                "mood": random.choice(["awesome", "happy", "neutral", "sad", "angry"]),
+                "notes": "",
+                "timestamp": now.isoformat(),
+            }
+
+    storage._save_data("habits", habits)
+    storage._save_data("tasks", tasks)
+    storage._save_data("mood", mood)
+    storage._save_data("admin_stats", {
+        "total_users": users,
+        "total_habits": len(habits),
+        "total_tasks": len(tasks),
+        "last_reset": None,
+    })
+    return len(habits) * progress_days
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.request = FakeRequest()
+        self.tg_bot = Bot(FAKE_TOKEN, request=self.request, get_updates_request=FakeRequest())
+        self.maximoy = maximoy.MaximoyBot()
+        self.storage = self.maximoy.storage
+        self.results = []
+        self._update_id = 0
+
+    def _random_user(self):
+        return random.randint(1, self.args.users)
+
+    async def _send(self, user_id, text, context=None):
+        self._update_id += 1
+        update = make_update(self.tg_bot, user_id, text, self._update_id)
+        context = context or FakeContext(self.tg_bot)
+        await self.maximoy.handle_message(update, context)
+        return context
+
+    # === СЦЕНАРИИ ===
+    async def flow_start(self):
+        self._update_id += 1
+        update = make_update(self.tg_bot, self._random_user(), "/start", self._update_id)
+        await self.maximoy.start(update, FakeContext(self.tg_bot))
+
+    async def flow_add_habit(self):
+        user_id = self._random_user()
+        context = await self._send(user_id, "➕ Новая привычка")
+        await self._send(user_id, self.maximoy.categories[0], context)
+        await self._send(user_id, "Бенчмарк | Привычка из бенчмарка", context)
+
+    async def flow_mark_habit(self):
+        user_id = self._random_user()
+        context = await self._send(user_id, "✅ Отметить выполнение")
+        await self._send(user_id, "1, 2", context)
+
+    async def flow_add_task(self):
+        # Обработчик process_new_task отсутствует в дереве, поэтому меряем хранилище
+        self.storage.add_task(self._random_user(), "Задача из бенчмарка", "", "medium")
+
+    async def flow_admin_stats(self):
+        await self._send(maximoy.ADMIN_ID, "📊 Статистика системы")
+
+    async def flow_export(self):
+        await self._send(maximoy.ADMIN_ID, "📤 Экспорт данных")
+
+    FLOWS = ["start", "add_habit", "mark_habit", "add_task", "admin_stats", "export"]
+
+    async def measure(self, name, iterations):
+        flow = getattr(self, f"flow_{name}")
+        calls_before = len(self.request.calls)
+        rss_before = peak_rss_mb()
+        latencies = []
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            await flow()
+            latencies.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - started
+        rss_after = peak_rss_mb()
+
+        latencies.sort()
+        result = {
+            "flow": name,
+            "iterations": iterations,
+            "ops_per_sec": iterations / elapsed if elapsed else 0.0,
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+            "peak_rss_mb": rss_after,
+            # Насколько сценарий поднял пик RSS (прогоны идут по порядку FLOWS)
+            "peak_rss_growth_mb": rss_after - rss_before,
+            "api_calls": len(self.request.calls) - calls_before,
+        }
+        self.results.append(result)
+        return result
+
+    async def run(self):
+        await self.tg_bot.initialize()
+
+        async def no_sleep(delay, result=None):
+            return result
+
+        # Приветственная анимация спит ~4 секунды, в бенчмарке это не нужно
+        with mock.patch.object(maximoy.asyncio, "sleep", no_sleep):
+            for name in self.args.flows:
+                result = await self.measure(name, self.args.iterations)
+                print(
+                    f"{result['flow']:<12} {result['ops_per_sec']:>10.1f} op/s "
+                    f"p50 {result['p50_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  "
+                    f"peak RSS {result['peak_rss_mb']:>8.1f} MB (+{result['peak_rss_growth_mb']:.1f})  "
+                    f"api {result['api_calls']}"
+                )
+
+        await self.tg_bot.shutdown()
+        return self.results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк Maximoy")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--habits-per-user", type=int, default=3)
+    parser.add_argument("--tasks-per-user", type=int, default=5)
+    parser.add_argument("--moods-per-user", type=int, default=5)
+    parser.add_argument("--progress-days", type=int, default=30)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--flows", nargs="+", choices=Benchmark.FLOWS, default=Benchmark.FLOWS)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="Сохранить результаты в JSON-файл для сравнения")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    data_dir = tempfile.mkdtemp(prefix="maximoy_bench_")
+    maximoy.DATA_DIR = data_dir
+    try:
+        benchmark = Benchmark(args)
+        progress_entries = generate_dataset(
+            benchmark.storage, args.users, args.habits_per_user,
+            args.tasks_per_user, args.progress_days, args.moods_per_user
+        )
+        print(f"📦 Dataset: {args.users} users, {progress_entries} progress entries ({data_dir}), "
+              f"peak RSS {peak_rss_mb():.1f} MB")
+        results = asyncio.run(benchmark.run())
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
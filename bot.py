@@ -1,12 +1,32 @@
 import os
+import re
+import sys
 import logging
 import json
 import datetime
 import random
 import asyncio
+import multiprocessing
+import queue as queue_module
+import uuid
+import pickle
+import gzip
+import gc
+import io
+import shutil
+import tempfile
+import threading
+import time
+import functools
+import contextvars
+import heapq
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes, TypeHandler
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
 # Загрузка переменных окружения
@@ -15,16 +35,313 @@ load_dotenv()
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.getenv('LOG_LEVEL', 'INFO').upper()
 )
 logger = logging.getLogger(__name__)
 
+# Доля сообщений, текст которых попадает в DEBUG-лог
+MESSAGE_LOG_SAMPLE_RATE = float(os.getenv('MESSAGE_LOG_SAMPLE_RATE', '0.01'))
+# Порт для /metrics (если не задан - HTTP-эндпоинт не поднимается)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
 # ID администратора
 ADMIN_ID = 6584350034
 
-class MaximoyStorage:
+# === МЕТРИКИ ===
+class Metrics:
+    """Счетчики и гистограммы в формате Prometheus"""
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
     def __init__(self):
-        self.data_dir = "/tmp/maximoy_data"
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started_at = time.time()
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @staticmethod
+    def _format_labels(labels, extra=None):
+        items = list(labels) + list(extra or [])
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    def render(self):
+        """Текстовый формат Prometheus"""
+        lines = []
+        with self._lock:
+            typed = None
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed = name
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name != typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed = name
+                for bound, count in zip(self.BUCKETS, hist["buckets"]):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {hist['sum']:.6f}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {hist['count']}")
+        lines.append("# TYPE maximoy_uptime_seconds gauge")
+        lines.append(f"maximoy_uptime_seconds {time.time() - self.started_at:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name):
+        """Количество и среднее время по каждой метке гистограммы"""
+        result = {}
+        with self._lock:
+            for (hist_name, labels), hist in self.histograms.items():
+                if hist_name == name and hist["count"]:
+                    label = "/".join(str(v) for _, v in labels)
+                    result[label] = (hist["count"], hist["sum"] / hist["count"])
+        return result
+
+
+METRICS = Metrics()
+# Обработчик, которым помечаются метрики текущего апдейта. handle_message
+# переписывает его на метод, в который отдал сообщение
+HANDLER_NAME = contextvars.ContextVar("handler_name")
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    """Поднимает /metrics в фоновом потоке"""
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"📈 Metrics available on :{port}/metrics")
+    return server
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTP-клиент Telegram с замером исходящих запросов"""
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            METRICS.inc("maximoy_telegram_errors_total", {"method": endpoint})
+            raise
+        finally:
+            METRICS.observe("maximoy_telegram_request_seconds", time.perf_counter() - start, {"method": endpoint})
+        METRICS.inc("maximoy_telegram_requests_total", {"method": endpoint, "code": code})
+        return code, payload
+
+# Хранилище и масштабирование
+DATA_DIR = "/tmp/maximoy_data"
+WORKERS = int(os.getenv('MAXIMOY_WORKERS', '1'))
+# Сколько раз фронт перезапускает упавших воркеров, прежде чем упасть сам
+WORKER_MAX_RESTARTS = int(os.getenv('MAXIMOY_WORKER_MAX_RESTARTS', '5'))
+WORKER_CHECK_INTERVAL = 5
+# Папка, в которой собирается новая раскладка при смене числа воркеров
+RESHARD_STAGING = "resharding"
+# Запросы админа к чужим шардам: пишет в шард только воркер-владелец
+RPC_METHODS = {"reset_all_data", "search"}
+RPC_TIMEOUT = 30
+DATA_TYPES = ["habits", "tasks", "mood", "achievements", "users", "admin_stats"]
+# Бинарный снапшот кеша для быстрого рестарта
+SNAPSHOT_ENABLED = os.getenv('MAXIMOY_SNAPSHOT', '1') == '1'
+SNAPSHOT_INTERVAL = int(os.getenv('MAXIMOY_SNAPSHOT_INTERVAL', '60'))
+# Снапшот пишется частями, чтобы чтение не держало GIL на весь файл
+SNAPSHOT_CHUNK = 1000
+# Ретеншн: старые записи уезжают из рабочих файлов в сжатый архив
+RETENTION_TASK_DAYS = int(os.getenv('RETENTION_TASK_DAYS', '30'))
+RETENTION_MOOD_DAYS = int(os.getenv('RETENTION_MOOD_DAYS', '90'))
+RETENTION_PROGRESS_DAYS = int(os.getenv('RETENTION_PROGRESS_DAYS', '90'))
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', '21600'))
+ARCHIVE_TYPES = ["tasks", "mood", "progress"]
+# Поиск: какие поля индексируются и до какой длины индексируются префиксы слов
+SEARCH_FIELDS = {"habits": ("name", "description"), "tasks": ("title", "description")}
+SEARCH_PREFIX_MIN = 3
+SEARCH_PREFIX_MAX = 20
+TOKEN_RE = re.compile(r"\w+")
+# Telegram режет сообщения длиннее 4096 символов, оставляем запас под заголовок
+SEARCH_DESCRIPTION_LIMIT = 80
+SEARCH_LINE_LIMIT = 300
+SEARCH_MESSAGE_LIMIT = 4000
+
+
+def shorten(text, limit):
+    """Обрезает текст до limit символов, добавляя многоточие"""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def tokenize(text):
+    """Разбивает текст на слова: нижний регистр, ё -> е"""
+    return TOKEN_RE.findall((text or "").lower().replace("ё", "е"))
+
+
+def shard_for_user(user_id, shards):
+    """Номер шарда (воркера), который владеет данными пользователя"""
+    if not user_id or shards <= 1:
+        return 0
+    return int(user_id) % shards
+
+
+def read_layout():
+    """Раскладка данных на диске: {"shards": N}. Если перенос зафиксирован,
+    но не доведен до конца, в ней есть "previous" - число шардов до него"""
+    try:
+        with open(os.path.join(DATA_DIR, "layout.json"), 'r', encoding='utf-8') as f:
+            layout = json.load(f)
+    except (OSError, ValueError):
+        layout = {}
+    # Раскладки еще нет: данные лежат в общей папке (один воркер)
+    return layout if "shards" in layout else {"shards": 1}
+
+
+def write_layout(layout):
+    path = os.path.join(DATA_DIR, "layout.json")
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(layout, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def shard_data_dir(shard_id, shards):
+    """Папка с данными шарда (при одном воркере - общая папка)"""
+    if shards <= 1:
+        return DATA_DIR
+    return os.path.join(DATA_DIR, f"shard_{shard_id}")
+
+
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+JSON_READ_CHUNK = 1 << 20
+
+
+def load_json_file(f):
+    """То же, что json.load, но файл читается частями, а объект верхнего уровня
+    разбирается по одной записи. json.load держит GIL на все декодирование и разбор,
+    а здесь между записями GIL может уйти к event loop"""
+    buffer = f.read(JSON_READ_CHUNK)
+    idx = 0
+    
+    def read_more():
+        nonlocal buffer, idx
+        chunk = f.read(JSON_READ_CHUNK)
+        if not chunk:
+            return False
+        buffer, idx = buffer[idx:] + chunk, 0
+        return True
+    
+    def next_char():
+        nonlocal idx
+        while True:
+            idx = JSON_WHITESPACE.match(buffer, idx).end()
+            if idx < len(buffer):
+                return buffer[idx]
+            if not read_more():
+                raise ValueError("Unexpected end of JSON")
+    
+    def next_value():
+        nonlocal idx
+        while True:
+            next_char()
+            try:
+                value, end = JSON_DECODER.raw_decode(buffer, idx)
+                # Значение целое, только если за ним уже виден разделитель: иначе число могло оборваться
+                after = JSON_WHITESPACE.match(buffer, end).end()
+                if after < len(buffer) and buffer[after] in ",:}":
+                    idx = end
+                    return value
+            except ValueError:
+                pass
+            if not read_more():
+                value, idx = JSON_DECODER.raw_decode(buffer, idx)
+                return value
+    
+    if next_char() != "{":
+        f.seek(0)
+        return json.load(f)
+    idx += 1
+    data = {}
+    if next_char() == "}":
+        return data
+    while True:
+        key = next_value()
+        if not isinstance(key, str):
+            raise ValueError(f"Expecting property name, got {key!r}")
+        if next_char() != ":":
+            raise ValueError(f"Expecting ':' delimiter after {key!r}")
+        idx += 1
+        data[key] = next_value()
+        delimiter = next_char()
+        idx += 1
+        if delimiter == "}":
+            return data
+        if delimiter != ",":
+            raise ValueError(f"Expecting ',' delimiter after {key!r}")
+
+
+def write_snapshot_file(path, key, text=None, json_path=None):
+    """Пишет снапшот одного файла: key, затем записи частями по SNAPSHOT_CHUNK.
+    Выполняется в отдельном процессе, поэтому разбор JSON и pickle не держат GIL бота.
+    Без text читает json_path, если тот не менялся после загрузки"""
+    if text is None:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            if MaximoyStorage._file_key(os.fstat(f.fileno())) != tuple(key):
+                # Файл уже сохранили заново, его снапшот придет со своим заданием
+                return
+            text = f.read()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    items = list(json.loads(text).items())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+        for i in range(0, len(items), SNAPSHOT_CHUNK):
+            pickle.dump(dict(items[i:i + SNAPSHOT_CHUNK]), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+class MaximoyStorage:
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+        self.archive_dir = os.path.join(self.data_dir, "archive")
+        # data_type -> ((mtime_ns, size), data): кеш валиден, пока файл не изменился
+        self._cache = {}
+        # Общая блокировка - для изменений, затрагивающих несколько файлов, индекса и снапшотов.
+        # Блокировка файла - для чтения и подмены одного файла. Порядок захвата: общая, потом файла
+        self._lock = threading.RLock()
+        self._file_locks = {data_type: threading.Lock() for data_type in DATA_TYPES}
+        # data_type -> (key, текст JSON или None - взять из файла): файлы, чей снапшот устарел
+        self._snapshot_pending = {}
+        # data_type -> {"key", "postings": {терм: {id}}, "user_postings": {user_id: {терм: {id}}},
+        #               "docs": {id: (user_id, термы)}}
+        self._search_index = {}
+        self.ready = threading.Event()
         os.makedirs(self.data_dir, exist_ok=True)
         self.init_storage()
     
@@ -52,44 +369,417 @@ class MaximoyStorage:
         
         logger.info("✅ Maximoy Storage initialized")
 
+    @staticmethod
+    def _file_key(stat):
+        return (stat.st_mtime_ns, stat.st_size)
+
     def _load_data(self, data_type):
-        """Загрузка данных из файла"""
+        """Загрузка данных из файла (или из кеша, если файл не менялся)"""
         filepath = os.path.join(self.data_dir, f"{data_type}.json")
+        start = time.perf_counter()
+        op = "load"
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            cached = self._cache.get(data_type)
+            if cached and cached[0] == self._file_key(os.stat(filepath)):
+                op = "hit"
+                return cached[1]
+            # Разбор держит блокировку только этого файла: остальные файлы в это время доступны,
+            # а второй поток, пришедший за тем же файлом, дождется и возьмет его из кеша
+            with self._file_locks[data_type], open(filepath, 'r', encoding='utf-8') as f:
+                stat = os.fstat(f.fileno())
+                key = self._file_key(stat)
+                cached = self._cache.get(data_type)
+                if cached and cached[0] == key:
+                    op = "hit"
+                    return cached[1]
+                METRICS.inc("maximoy_storage_bytes_total", {"op": "load", "file": data_type}, stat.st_size)
+                data = load_json_file(f)
+                self._cache[data_type] = (key, data)
+            with self._lock:
+                self._snapshot_pending[data_type] = (key, None)
+            return data
         except:
             return {}
+        finally:
+            METRICS.observe("maximoy_storage_seconds", time.perf_counter() - start, {"op": op, "file": data_type})
 
-    def _save_data(self, data_type, data):
-        """Сохранение данных в файл"""
+    def _save_data(self, data_type, data, keep_index=False):
+        """Сохранение данных в файл.
+        keep_index=True - вызывающий сам обновил поисковый индекс, иначе индекс сбрасывается"""
         filepath = os.path.join(self.data_dir, f"{data_type}.json")
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # Пишем во временный файл и подменяем атомарно, чтобы другие
+        # воркеры никогда не читали наполовину записанный JSON
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        start = time.perf_counter()
+        text = json.dumps(data, ensure_ascii=False, indent=2)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        # В кеш кладем то, что вернет чтение JSON (например, ключи-числа станут строками),
+        # чтобы кеш, снапшот и повторное чтение файла давали одинаковые данные
+        data = load_json_file(io.StringIO(text))
+        METRICS.inc("maximoy_storage_bytes_total", {"op": "save", "file": data_type}, os.path.getsize(tmp_path))
+        with self._lock, self._file_locks[data_type]:
+            old_key = self._cache.get(data_type, (None,))[0]
+            os.replace(tmp_path, filepath)
+            key = self._file_key(os.stat(filepath))
+            self._cache[data_type] = (key, data)
+            self._snapshot_pending[data_type] = (key, text)
+            index = self._search_index.get(data_type)
+            if index is not None:
+                # Индекс переживает сохранение, только если он соответствовал данным до изменения
+                if keep_index and index["key"] == old_key:
+                    index["key"] = key
+                else:
+                    del self._search_index[data_type]
+        METRICS.observe("maximoy_storage_seconds", time.perf_counter() - start, {"op": "save", "file": data_type})
+
+    # === ХОЛОДНЫЙ СТАРТ ===
+    def warm_up(self):
+        """Прогревает кеш: сначала из снапшота, остальное из JSON. Запускается в фоне,
+        обработчики ждут ready и не трогают хранилище до конца прогрева"""
+        start = time.perf_counter()
+        # Паузы сборщика мусора на миллионах новых объектов останавливают и event loop
+        gc.disable()
+        try:
+            restored = self.restore_snapshot() if SNAPSHOT_ENABLED else 0
+            for data_type in DATA_TYPES:
+                self._load_data(data_type)
+            # Поисковый индекс тоже строим до ready, а не на первом /find
+            for data_type in SEARCH_FIELDS:
+                self.build_index(data_type)
+            logger.info(f"🔥 Storage warmed up in {(time.perf_counter() - start) * 1000:.0f} ms "
+                        f"({restored}/{len(DATA_TYPES)} from snapshot)")
+        except Exception:
+            # Без прогрева бот все равно работает: файлы загрузятся при первом обращении
+            logger.exception("❌ Storage warm-up failed")
+        finally:
+            # Прогретый кеш живет долго: сборщику мусора незачем обходить его снова
+            gc.freeze()
+            gc.enable()
+            self.ready.set()
+
+    def _snapshot_path(self, data_type):
+        return os.path.join(self.data_dir, f"snapshot_{data_type}.pickle")
+
+    def restore_snapshot(self):
+        """Берет из снапшотов только те файлы, которые не менялись после их записи"""
+        restored = 0
+        for data_type in DATA_TYPES:
+            try:
+                current_key = self._file_key(os.stat(os.path.join(self.data_dir, f"{data_type}.json")))
+                with open(self._snapshot_path(data_type), 'rb') as f:
+                    if tuple(pickle.load(f)) != current_key:
+                        continue
+                    data = {}
+                    while True:
+                        try:
+                            data.update(pickle.load(f))
+                        except EOFError:
+                            break
+            except Exception:
+                continue
+            with self._file_locks[data_type]:
+                if data_type not in self._cache:
+                    self._cache[data_type] = (current_key, data)
+                    restored += 1
+        return restored
+
+    def take_snapshot_jobs(self):
+        """Задания (путь, key, текст, путь JSON) для файлов, изменившихся с прошлого снапшота"""
+        with self._lock:
+            pending, self._snapshot_pending = self._snapshot_pending, {}
+        return [
+            (self._snapshot_path(data_type), key, text, os.path.join(self.data_dir, f"{data_type}.json"))
+            for data_type, (key, text) in pending.items()
+        ]
+
+    def save_snapshot(self):
+        """Синхронно пишет снапшоты изменившихся файлов (при остановке)"""
+        jobs = self.take_snapshot_jobs()
+        for job in jobs:
+            write_snapshot_file(*job)
+        return len(jobs)
+
+    # === АРХИВ ===
+    def _archive_segments(self, archive_type):
+        """Сегменты архива в порядке записи"""
+        try:
+            names = os.listdir(self.archive_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            os.path.join(self.archive_dir, name) for name in names
+            if name.startswith(f"{archive_type}-") and name.endswith(".jsonl.gz")
+        )
+
+    def _write_segment(self, archive_type, records):
+        """Пишет новый сегмент. Сегменты никогда не перезаписываются"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        # Количество записей хранится в имени, чтобы считать архив без распаковки
+        name = f"{archive_type}-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{len(records)}.jsonl.gz"
+        path = os.path.join(self.archive_dir, name)
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+        return path
+
+    def iter_archive(self, archive_type, user_id=None):
+        """Потоково читает записи архива (tasks, mood или progress)"""
+        for path in self._archive_segments(archive_type):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if user_id is None or record["user_id"] == user_id:
+                        yield record
+
+    def get_archive_stats(self):
+        """Количество записей в архиве по типам"""
+        stats = {}
+        for archive_type in ARCHIVE_TYPES:
+            stats[archive_type] = sum(
+                int(os.path.basename(path).rsplit("-", 1)[1].split(".", 1)[0])
+                for path in self._archive_segments(archive_type)
+            )
+        return stats
+
+    def _archive_records(self, data_type, is_expired):
+        """Переносит просроченные записи data_type в архив.
+        Под блокировкой только поиск и удаление записей, сегмент пишется без нее"""
+        with self._lock:
+            data = self._load_data(data_type)
+            expired = []
+            for item_id, item in data.items():
+                try:
+                    if is_expired(item):
+                        expired.append(item_id)
+                except (KeyError, TypeError, ValueError):
+                    # Битую дату пропускаем, чтобы не блокировать перенос остальных записей
+                    logger.warning(f"⚠️ Skipping malformed {data_type} record {item_id}")
+        if not expired:
+            return 0
+        
+        # Сначала архив, потом рабочий файл: при падении между ними запись
+        # продублируется, но не потеряется. Просроченные записи уже не меняются
+        segment = self._write_segment(data_type, [{"id": item_id, **data[item_id]} for item_id in expired])
+        with self._lock:
+            data = self._load_data(data_type)
+            moved = {item_id for item_id in expired if item_id in data}
+            if not moved:
+                # Данные сбросили, пока писался сегмент
+                os.remove(segment)
+                return 0
+            for item_id in moved:
+                self._unindex_item(data_type, item_id)
+            # Новый словарь вместо удаления на месте: обработчики могут в это время обходить старый
+            self._save_data(data_type, {k: v for k, v in data.items() if k not in moved}, keep_index=True)
+        return len(moved)
+
+    def _archive_progress(self, cutoff_day):
+        """Переносит дневные отметки привычек старше cutoff_day в архив"""
+        with self._lock:
+            habits = self._load_data("habits")
+            expired = [
+                (habit_id, day) for habit_id, habit in habits.items()
+                for day in habit.get("progress", {}) if day < cutoff_day
+            ]
+        if not expired:
+            return 0
+        
+        records = []
+        for habit_id, day in expired:
+            habit = habits.get(habit_id)
+            entry = habit and habit["progress"].get(day)
+            if entry:
+                records.append({"habit_id": habit_id, "user_id": habit["user_id"], "date": day, **entry})
+        expired = [(record["habit_id"], record["date"]) for record in records]
+        segment = self._write_segment("progress", records)
+        with self._lock:
+            habits = dict(self._load_data("habits"))
+            copied = set()
+            moved = 0
+            for habit_id, day in expired:
+                habit = habits.get(habit_id)
+                if habit is None or day not in habit["progress"]:
+                    continue
+                if habit_id not in copied:
+                    # Копия привычки и ее отметок: оригиналы в это время могут обходить обработчики
+                    habit = habits[habit_id] = {**habit, "progress": dict(habit["progress"])}
+                    copied.add(habit_id)
+                del habit["progress"][day]
+                moved += 1
+            if not moved:
+                os.remove(segment)
+                return 0
+            self._save_data("habits", habits, keep_index=True)
+        return moved
+
+    def apply_retention(self, now=None):
+        """Переносит старые данные в архив, возвращает количество перенесенных записей.
+        Выполняется в потоке, обработчики в это время работают"""
+        now = now or datetime.datetime.now()
+        task_cutoff = now - timedelta(days=RETENTION_TASK_DAYS)
+        mood_cutoff = now - timedelta(days=RETENTION_MOOD_DAYS)
+        progress_cutoff = (now - timedelta(days=RETENTION_PROGRESS_DAYS)).strftime("%Y-%m-%d")
+        
+        return {
+            "tasks": self._archive_records("tasks", lambda task: task["completed"] and datetime.datetime.fromisoformat(
+                task.get("completed_date") or task["created_date"]) < task_cutoff),
+            "mood": self._archive_records("mood", lambda entry: datetime.datetime.fromisoformat(
+                entry["timestamp"]) < mood_cutoff),
+            "progress": self._archive_progress(progress_cutoff),
+        }
+
+    # === ПОИСК ===
+    @staticmethod
+    def _item_terms(data_type, item):
+        """Термы документа: слова целиком и их префиксы (для поиска по началу слова)"""
+        terms = set()
+        for field in SEARCH_FIELDS[data_type]:
+            for token in tokenize(item.get(field)):
+                terms.add(token)
+                for n in range(SEARCH_PREFIX_MIN, min(len(token), SEARCH_PREFIX_MAX) + 1):
+                    terms.add(token[:n])
+        return terms
+
+    @staticmethod
+    def _query_terms(query):
+        return {token[:SEARCH_PREFIX_MAX] for token in tokenize(query)}
+
+    def _get_index(self, data_type):
+        """Индекс, соответствующий текущему файлу. Вызывается под self._lock"""
+        data = self._load_data(data_type)
+        key = self._cache.get(data_type, (None,))[0]
+        index = self._search_index.get(data_type)
+        if index is None or index["key"] != key:
+            # Обычно индекс уже построен build_index, сюда попадаем только при гонке с записью
+            index = self._new_index(data_type, key, data.items())
+            self._search_index[data_type] = index
+        return index, data
+
+    def build_index(self, data_type):
+        """Строит индекс, если он сброшен или устарел. Долгая часть идет без общей блокировки,
+        поэтому вызывается из потока: при прогреве и из поиска в executor"""
+        self._load_data(data_type)
+        with self._lock:
+            cached = self._cache.get(data_type)
+            index = self._search_index.get(data_type)
+            if cached is None or (index is not None and index["key"] == cached[0]):
+                return
+            items = list(cached[1].items())
+        
+        # Название и описание записи не меняются, поэтому записи можно читать без блокировки
+        index = self._new_index(data_type, cached[0], items)
+        
+        with self._lock:
+            # Догоняем записи, добавленные и удаленные, пока индекс строился
+            key, data = self._cache[data_type]
+            for item_id in index["docs"].keys() - data.keys():
+                self._index_remove(index, item_id)
+            for item_id in data.keys() - index["docs"].keys():
+                self._index_add(index, data_type, item_id, data[item_id])
+            index["key"] = key
+            self._search_index[data_type] = index
+
+    @classmethod
+    def _new_index(cls, data_type, key, items):
+        index = {"key": key, "postings": {}, "user_postings": {}, "docs": {}}
+        for item_id, item in items:
+            cls._index_add(index, data_type, item_id, item)
+        return index
+
+    def _index_item(self, data_type, item_id, item):
+        index = self._search_index.get(data_type)
+        if index is not None:
+            self._index_add(index, data_type, item_id, item)
+
+    def _unindex_item(self, data_type, item_id):
+        index = self._search_index.get(data_type)
+        if index is not None:
+            self._index_remove(index, item_id)
+
+    @classmethod
+    def _index_add(cls, index, data_type, item_id, item):
+        cls._index_remove(index, item_id)
+        user_id = item["user_id"]
+        terms = cls._item_terms(data_type, item)
+        index["docs"][item_id] = (user_id, terms)
+        # Отдельные списки на пользователя: его поиск не зависит от чужих записей
+        user_postings = index["user_postings"].setdefault(user_id, {})
+        for term in terms:
+            index["postings"].setdefault(term, set()).add(item_id)
+            user_postings.setdefault(term, set()).add(item_id)
+
+    @staticmethod
+    def _index_remove(index, item_id):
+        if item_id not in index["docs"]:
+            return
+        user_id, terms = index["docs"].pop(item_id)
+        user_postings = index["user_postings"].get(user_id, {})
+        for term in terms:
+            for postings_by_term in (index["postings"], user_postings):
+                postings = postings_by_term.get(term)
+                if postings is not None:
+                    postings.discard(item_id)
+                    if not postings:
+                        del postings_by_term[term]
+        if not user_postings:
+            index["user_postings"].pop(user_id, None)
+
+    def search(self, query, user_id=None, limit=20):
+        """Ищет привычки и задачи, где есть все слова запроса (или слова с таким началом).
+        Возвращает список (data_type, item_id, item)"""
+        terms = self._query_terms(query)
+        if not terms:
+            return []
+        
+        # Сброшенный индекс (например, после сброса данных) перестраивается здесь,
+        # поэтому обработчики вызывают поиск в executor
+        for data_type in SEARCH_FIELDS:
+            self.build_index(data_type)
+        
+        results = []
+        with self._lock:
+            for data_type in SEARCH_FIELDS:
+                index, data = self._get_index(data_type)
+                if user_id is None:
+                    postings_by_term = index["postings"]
+                else:
+                    postings_by_term = index["user_postings"].get(user_id, {})
+                postings = sorted((postings_by_term.get(term, set()) for term in terms), key=len)
+                for item_id in set.intersection(*postings):
+                    item = data.get(item_id)
+                    if item is not None:
+                        results.append((data_type, item_id, item))
+        
+        return heapq.nlargest(limit, results, key=lambda x: x[2]["created_date"])
 
     # === ХАБИТЫ ===
     def add_habit(self, user_id, name, description="", category="general", difficulty="medium"):
-        habits = self._load_data("habits")
-        admin_stats = self._load_data("admin_stats")
-        
-        habit_id = str(int(datetime.datetime.now().timestamp() * 1000))
-        habits[habit_id] = {
-            "user_id": user_id,
-            "name": name,
-            "description": description,
-            "category": category,
-            "difficulty": difficulty,
-            "streak": 0,
-            "best_streak": 0,
-            "total_completed": 0,
-            "created_date": datetime.datetime.now().isoformat(),
-            "progress": {}
-        }
-        
-        admin_stats["total_habits"] += 1
-        self._save_data("habits", habits)
-        self._save_data("admin_stats", admin_stats)
-        return habit_id
+        with self._lock:
+            habits = self._load_data("habits")
+            admin_stats = self._load_data("admin_stats")
+            
+            habit_id = str(int(datetime.datetime.now().timestamp() * 1000))
+            habits[habit_id] = {
+                "user_id": user_id,
+                "name": name,
+                "description": description,
+                "category": category,
+                "difficulty": difficulty,
+                "streak": 0,
+                "best_streak": 0,
+                "total_completed": 0,
+                "created_date": datetime.datetime.now().isoformat(),
+                "progress": {}
+            }
+            
+            admin_stats["total_habits"] += 1
+            self._index_item("habits", habit_id, habits[habit_id])
+            self._save_data("habits", habits, keep_index=True)
+            self._save_data("admin_stats", admin_stats)
+            return habit_id
 
     def get_user_habits(self, user_id):
         habits = self._load_data("habits")
@@ -107,46 +797,63 @@ class MaximoyStorage:
         return self._load_data("habits")
 
     def mark_habit_done(self, habit_id):
-        habits = self._load_data("habits")
-        
-        if habit_id in habits:
+        return habit_id in self.mark_habits_done([habit_id])
+
+    def mark_habits_done(self, habit_ids, user_id=None):
+        """Отмечает несколько привычек за одно сохранение, возвращает найденные ID.
+        Если передан user_id, чужие привычки пропускаются"""
+        with self._lock:
+            habits = self._load_data("habits")
             today = datetime.datetime.now().strftime("%Y-%m-%d")
-            habit = habits[habit_id]
-            
-            habit["progress"][today] = {
-                "completed": True,
-                "timestamp": datetime.datetime.now().isoformat()
-            }
+            found = []
+            changed = False
             
-            habit["streak"] += 1
-            habit["total_completed"] += 1
-            if habit["streak"] > habit["best_streak"]:
-                habit["best_streak"] = habit["streak"]
+            for habit_id in habit_ids:
+                habit = habits.get(habit_id)
+                if habit is None or (user_id is not None and habit["user_id"] != user_id):
+                    continue
+                found.append(habit_id)
+                # Повторная отметка за день не накручивает стрик
+                if habit["progress"].get(today, {}).get("completed"):
+                    continue
+                
+                habit["progress"][today] = {
+                    "completed": True,
+                    "timestamp": datetime.datetime.now().isoformat()
+                }
+                
+                habit["streak"] += 1
+                habit["total_completed"] += 1
+                if habit["streak"] > habit["best_streak"]:
+                    habit["best_streak"] = habit["streak"]
+                changed = True
             
-            self._save_data("habits", habits)
-            return True
-        return False
+            if changed:
+                self._save_data("habits", habits, keep_index=True)
+            return found
 
     # === ЗАДАЧИ ===
     def add_task(self, user_id, title, description="", priority="medium", due_date=None):
-        tasks = self._load_data("tasks")
-        admin_stats = self._load_data("admin_stats")
-        
-        task_id = str(int(datetime.datetime.now().timestamp() * 1000))
-        tasks[task_id] = {
-            "user_id": user_id,
-            "title": title,
-            "description": description,
-            "priority": priority,
-            "due_date": due_date,
-            "completed": False,
-            "created_date": datetime.datetime.now().isoformat()
-        }
-        
-        admin_stats["total_tasks"] += 1
-        self._save_data("tasks", tasks)
-        self._save_data("admin_stats", admin_stats)
-        return task_id
+        with self._lock:
+            tasks = self._load_data("tasks")
+            admin_stats = self._load_data("admin_stats")
+            
+            task_id = str(int(datetime.datetime.now().timestamp() * 1000))
+            tasks[task_id] = {
+                "user_id": user_id,
+                "title": title,
+                "description": description,
+                "priority": priority,
+                "due_date": due_date,
+                "completed": False,
+                "created_date": datetime.datetime.now().isoformat()
+            }
+            
+            admin_stats["total_tasks"] += 1
+            self._index_item("tasks", task_id, tasks[task_id])
+            self._save_data("tasks", tasks, keep_index=True)
+            self._save_data("admin_stats", admin_stats)
+            return task_id
 
     def get_user_tasks(self, user_id, completed=False):
         tasks = self._load_data("tasks")
@@ -165,28 +872,46 @@ class MaximoyStorage:
         return self._load_data("tasks")
 
     def mark_task_completed(self, task_id):
-        tasks = self._load_data("tasks")
-        
-        if task_id in tasks:
-            tasks[task_id]["completed"] = True
-            self._save_data("tasks", tasks)
-            return True
-        return False
+        return task_id in self.complete_tasks([task_id])
+
+    def complete_tasks(self, task_ids, user_id=None):
+        """Завершает несколько задач за одно сохранение, возвращает найденные ID.
+        Если передан user_id, чужие задачи пропускаются"""
+        with self._lock:
+            tasks = self._load_data("tasks")
+            now = datetime.datetime.now().isoformat()
+            found = []
+            changed = False
+            
+            for task_id in task_ids:
+                task = tasks.get(task_id)
+                if task is None or (user_id is not None and task["user_id"] != user_id):
+                    continue
+                found.append(task_id)
+                if not task["completed"]:
+                    task["completed"] = True
+                    task["completed_date"] = now
+                    changed = True
+            
+            if changed:
+                self._save_data("tasks", tasks, keep_index=True)
+            return found
 
     # === НАСТРОЕНИЕ ===
     def add_mood_entry(self, user_id, mood, notes=""):
-        mood_data = self._load_data("mood")
-        
-        entry_id = str(int(datetime.datetime.now().timestamp() * 1000))
-        mood_data[entry_id] = {
-            "user_id": user_id,
-            "mood": mood,
-            "notes": notes,
-            "timestamp": datetime.datetime.now().isoformat()
-        }
-        
-        self._save_data("mood", mood_data)
-        return entry_id
+        with self._lock:
+            mood_data = self._load_data("mood")
+            
+            entry_id = str(int(datetime.datetime.now().timestamp() * 1000))
+            mood_data[entry_id] = {
+                "user_id": user_id,
+                "mood": mood,
+                "notes": notes,
+                "timestamp": datetime.datetime.now().isoformat()
+            }
+            
+            self._save_data("mood", mood_data)
+            return entry_id
 
     def get_user_mood_stats(self, user_id, days=7):
         mood_data = self._load_data("mood")
@@ -200,24 +925,40 @@ class MaximoyStorage:
                 if entry_date >= cutoff_date:
                     user_moods.append(entry)
         
+        # Запрос длиннее срока хранения - добираем записи из архива
+        if days > RETENTION_MOOD_DAYS:
+            for entry in self.iter_archive("mood", user_id):
+                if datetime.datetime.fromisoformat(entry["timestamp"]) >= cutoff_date:
+                    user_moods.append(entry)
+        
         return user_moods
 
     # === ДОСТИЖЕНИЯ ===
     def unlock_achievement(self, user_id, achievement_id):
-        achievements = self._load_data("achievements")
-        
-        if user_id not in achievements:
-            achievements[user_id] = {}
-        
-        achievements[user_id][achievement_id] = {
-            "unlocked_at": datetime.datetime.now().isoformat()
-        }
-        
-        self._save_data("achievements", achievements)
+        self.unlock_achievements(user_id, [achievement_id])
+
+    def unlock_achievements(self, user_id, achievement_ids):
+        """Открывает несколько достижений за одно сохранение, возвращает новые.
+        Ключ - str(user_id): в JSON ключи словаря всегда строки"""
+        with self._lock:
+            achievements = self._load_data("achievements")
+            # Только чтение: кэш не трогаем, пока не ясно, что будет сохранение
+            user_achievements = achievements.get(str(user_id), {})
+            unlocked = [a for a in dict.fromkeys(achievement_ids) if a not in user_achievements]
+            if not unlocked:
+                return []
+            
+            now = datetime.datetime.now().isoformat()
+            user_achievements = achievements.setdefault(str(user_id), {})
+            for achievement_id in unlocked:
+                user_achievements[achievement_id] = {"unlocked_at": now}
+            
+            self._save_data("achievements", achievements)
+            return unlocked
 
     def get_user_achievements(self, user_id):
         achievements = self._load_data("achievements")
-        return achievements.get(user_id, {})
+        return achievements.get(str(user_id), {})
 
     # === АДМИН ФУНКЦИИ ===
     def get_admin_stats(self):
@@ -252,24 +993,138 @@ class MaximoyStorage:
             }
         }
         
-        for filename, data in default_data.items():
-            filepath = os.path.join(self.data_dir, f"{filename}.json")
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+        with self._lock:
+            for filename, data in default_data.items():
+                self._save_data(filename, data)
+            shutil.rmtree(self.archive_dir, ignore_errors=True)
         
         return True
 
-    def export_data(self):
-        """Экспорт всех данных"""
-        data = {}
-        for filename in ["habits", "tasks", "mood", "achievements", "admin_stats"]:
-            data[filename] = self._load_data(filename)
-        return json.dumps(data, ensure_ascii=False, indent=2)
+    def export_data(self, out):
+        """Экспорт всех данных в текстовый файл out. Архив пишется потоком, по записи"""
+        out.write("{\n")
+        with self._lock:
+            for filename in ["habits", "tasks", "mood", "achievements", "admin_stats"]:
+                out.write(f'"{filename}": ')
+                json.dump(self._load_data(filename), out, ensure_ascii=False, indent=2)
+                out.write(",\n")
+        out.write('"archive": {')
+        for i, archive_type in enumerate(ARCHIVE_TYPES):
+            out.write(f'{"," if i else ""}\n"{archive_type}": [')
+            for j, record in enumerate(self.iter_archive(archive_type)):
+                out.write(f'{"," if j else ""}\n{json.dumps(record, ensure_ascii=False)}')
+            out.write("\n]")
+        out.write("\n}\n}")
+
+class ShardedStorage:
+    """Админский доступ ко всем шардам: запрос рассылается по шардам, ответы сливаются.
+    Чтение идет напрямую из файлов, изменения - через очередь воркера-владельца"""
+    def __init__(self, shards, shard_id=0, queues=None, reply_queues=None, own_storage=None):
+        self.shard_id = shard_id
+        self.queues = queues
+        self.reply_queues = reply_queues
+        self.shards = [MaximoyStorage(shard_data_dir(i, shards)) for i in range(shards)]
+        if own_storage is not None:
+            # Свой шард - то же хранилище, что у обработчиков: общий кеш и поисковый индекс
+            self.shards[shard_id] = own_storage
+
+    async def call(self, method, *args):
+        """Выполняет метод хранилища на каждом воркере, возвращает ответы по порядку шардов"""
+        request_id = uuid.uuid4().hex
+        for i, worker_queue in enumerate(self.queues):
+            if i != self.shard_id:
+                worker_queue.put({"rpc": method, "args": args, "reply_to": self.shard_id, "request_id": request_id})
+        # Свой шард обрабатываем сами: мы и есть его владелец
+        loop = asyncio.get_running_loop()
+        own_method = getattr(self.shards[self.shard_id], method)
+        results = {self.shard_id: await loop.run_in_executor(None, functools.partial(own_method, *args))}
+        
+        deadline = loop.time() + RPC_TIMEOUT
+        while len(results) < len(self.shards):
+            remaining = deadline - loop.time()
+            try:
+                if remaining <= 0:
+                    raise queue_module.Empty
+                reply = await loop.run_in_executor(None, self.reply_queues[self.shard_id].get, True, remaining)
+            except queue_module.Empty:
+                missing = sorted(set(range(len(self.shards))) - set(results))
+                raise TimeoutError(f"No reply to {method} from workers {missing}")
+            # Ответы на прошлые запросы, не дождавшиеся таймаута, пропускаем
+            if reply["request_id"] == request_id:
+                results[reply["shard_id"]] = reply["result"]
+        return [results[i] for i in range(len(self.shards))]
+
+    def _merge_dicts(self, method):
+        # ID генерируются независимо в каждом шарде, поэтому добавляем номер шарда
+        merged = {}
+        for i, shard in enumerate(self.shards):
+            for item_id, item in getattr(shard, method)().items():
+                merged[f"{i}:{item_id}"] = item
+        return merged
+
+    def get_all_habits(self):
+        return self._merge_dicts("get_all_habits")
+
+    def get_all_tasks(self):
+        return self._merge_dicts("get_all_tasks")
+
+    def get_admin_stats(self):
+        """Суммирует счетчики всех шардов"""
+        merged = {"total_users": 0, "total_habits": 0, "total_tasks": 0, "last_reset": None}
+        for shard in self.shards:
+            stats = shard.get_admin_stats()
+            for key in ("total_users", "total_habits", "total_tasks"):
+                merged[key] += stats.get(key, 0)
+            last_reset = stats.get("last_reset")
+            if last_reset and (merged["last_reset"] is None or last_reset > merged["last_reset"]):
+                merged["last_reset"] = last_reset
+        return merged
+
+    def get_all_users(self):
+        users = set()
+        for shard in self.shards:
+            users.update(shard.get_all_users())
+        return list(users)
+
+    def get_archive_stats(self):
+        merged = {archive_type: 0 for archive_type in ARCHIVE_TYPES}
+        for shard in self.shards:
+            for archive_type, count in shard.get_archive_stats().items():
+                merged[archive_type] += count
+        return merged
+
+    async def search(self, query, limit=20):
+        """Глобальный поиск: каждый шард ищет воркер-владелец по своему актуальному индексу.
+        Индекс чужого шарда в этом процессе перестраивался бы после каждой записи владельца"""
+        results = []
+        for i, shard_results in enumerate(await self.call("search", query, None, limit)):
+            for data_type, item_id, item in shard_results:
+                results.append((data_type, f"{i}:{item_id}", item))
+        return heapq.nlargest(limit, results, key=lambda x: x[2]["created_date"])
+
+    def export_data(self, out):
+        """Экспорт всех шардов одним документом"""
+        out.write("{")
+        for i, shard in enumerate(self.shards):
+            out.write(f'{"," if i else ""}\n"shard_{i}": ')
+            shard.export_data(out)
+        out.write("\n}")
 
 class MaximoyBot:
-    def __init__(self):
+    # Сколько строк выводить в каждой секции производительности
+    METRICS_SUMMARY_LIMIT = 5
+
+    def __init__(self, shard_id=0, shards=1, queues=None, reply_queues=None):
         self.token = os.getenv('TELEGRAM_BOT_TOKEN')
-        self.storage = MaximoyStorage()
+        self.shard_id = shard_id
+        self.shards = shards
+        # Данные пользователей этого воркера
+        self.storage = MaximoyStorage(shard_data_dir(shard_id, shards))
+        # Админские запросы идут по всем шардам
+        if shards > 1:
+            self.admin_storage = ShardedStorage(shards, shard_id, queues, reply_queues, self.storage)
+        else:
+            self.admin_storage = self.storage
         
         # Эмодзи для настроения
         self.mood_emojis = {
@@ -306,6 +1161,12 @@ class MaximoyBot:
         
         logger.info("🤖 Maximoy Bot initialized")
 
+    async def _admin_call(self, method, *args):
+        """Выполняет изменяющий метод хранилища на всех шардах, возвращает список ответов"""
+        if self.shards == 1:
+            return [getattr(self.storage, method)(*args)]
+        return await self.admin_storage.call(method, *args)
+
     def is_admin(self, user_id):
         """Проверка является ли пользователь админом"""
         return user_id == ADMIN_ID
@@ -316,7 +1177,7 @@ class MaximoyBot:
             [KeyboardButton("📊 Мой прогресс"), KeyboardButton("🎯 Привычки")],
             [KeyboardButton("✅ Задачи"), KeyboardButton("😊 Настроение")],
             [KeyboardButton("🏆 Достижения"), KeyboardButton("💫 Мотивация")],
-            [KeyboardButton("ℹ️ Помощь")]
+            [KeyboardButton("🔍 Поиск"), KeyboardButton("ℹ️ Помощь")]
         ]
         
         # Добавляем админ-панель для админа
@@ -356,7 +1217,8 @@ class MaximoyBot:
             [KeyboardButton("📊 Статистика системы"), KeyboardButton("👥 Все пользователи")],
             [KeyboardButton("📈 Аналитика привычек"), KeyboardButton("✅ Аналитика задач")],
             [KeyboardButton("🔄 Сбросить данные"), KeyboardButton("📤 Экспорт данных")],
-            [KeyboardButton("🎮 Тестовые функции"), KeyboardButton("🔙 Назад")]
+            [KeyboardButton("🔍 Глобальный поиск"), KeyboardButton("🎮 Тестовые функции")],
+            [KeyboardButton("🔙 Назад")]
         ], resize_keyboard=True)
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -428,11 +1290,14 @@ class MaximoyBot:
         text = update.message.text
         user_id = update.effective_user.id
         
-        logger.info(f"📨 Message from {user_id}: {text}")
+        METRICS.inc("maximoy_messages_total")
+        # Текст сообщений пишем только в DEBUG и только выборочно
+        if logger.isEnabledFor(logging.DEBUG) and random.random() < MESSAGE_LOG_SAMPLE_RATE:
+            logger.debug(f"📨 Message from {user_id}: {text}")
         
         # Главное меню
         if text == "📊 Мой прогресс":
-            await self.show_progress(update, context)
+            await self._route(self.show_progress, update, context)
         elif text == "🎯 Привычки":
             await update.message.reply_text(
                 "🎯 *Управление привычками*\n\nВыбери действие:",
@@ -452,11 +1317,13 @@ class MaximoyBot:
                 parse_mode='MarkdownV2'
             )
         elif text == "🏆 Достижения":
-            await self.show_achievements(update, context)
+            await self._route(self.show_achievements, update, context)
         elif text == "💫 Мотивация":
-            await self.send_motivation(update, context)
+            await self._route(self.send_motivation, update, context)
         elif text == "ℹ️ Помощь":
-            await self.show_help(update, context)
+            await self._route(self.show_help, update, context)
+        elif text == "🔍 Поиск":
+            await self._route(self.ask_search_query, update, context, 'find')
         elif text == "🔙 Назад":
             await update.message.reply_text(
                 "🔙 *Возвращаемся в главное меню*",
@@ -472,33 +1339,35 @@ class MaximoyBot:
                 parse_mode='MarkdownV2'
             )
         elif text == "📊 Статистика системы" and self.is_admin(user_id):
-            await self.show_system_stats(update, context)
+            await self._route(self.show_system_stats, update, context)
         elif text == "👥 Все пользователи" and self.is_admin(user_id):
-            await self.show_all_users(update, context)
+            await self._route(self.show_all_users, update, context)
         elif text == "📈 Аналитика привычек" and self.is_admin(user_id):
-            await self.show_habits_analytics(update, context)
+            await self._route(self.show_habits_analytics, update, context)
         elif text == "✅ Аналитика задач" and self.is_admin(user_id):
-            await self.show_tasks_analytics(update, context)
+            await self._route(self.show_tasks_analytics, update, context)
         elif text == "🔄 Сбросить данные" and self.is_admin(user_id):
-            await self.confirm_reset_data(update, context)
+            await self._route(self.confirm_reset_data, update, context)
         elif text == "📤 Экспорт данных" and self.is_admin(user_id):
-            await self.export_all_data(update, context)
+            await self._route(self.export_all_data, update, context)
+        elif text == "🔍 Глобальный поиск" and self.is_admin(user_id):
+            await self._route(self.ask_search_query, update, context, 'admin_find')
         elif text == "🎮 Тестовые функции" and self.is_admin(user_id):
-            await self.show_test_functions(update, context)
+            await self._route(self.show_test_functions, update, context)
         
         # Обработка привычек
         elif text == "📋 Мои привычки":
-            await self.show_habits(update, context)
+            await self._route(self.show_habits, update, context)
         elif text == "➕ Новая привычка":
-            await self.show_habit_categories(update, context)
+            await self._route(self.show_habit_categories, update, context)
         elif text == "✅ Отметить выполнение":
-            await self.show_habits_to_mark(update, context)
+            await self._route(self.show_habits_to_mark, update, context)
         elif text == "📈 Статистика":
-            await self.show_habits_stats(update, context)
+            await self._route(self.show_habits_stats, update, context)
         
         # Обработка задач
         elif text == "📝 Активные задачи":
-            await self.show_tasks(update, context)
+            await self._route(self.show_tasks, update, context)
         elif text == "🆕 Новая задача":
             await update.message.reply_text(
                 "✅ *Создание новой задачи*\n\n"
@@ -511,7 +1380,7 @@ class MaximoyBot:
             )
             context.user_data['waiting_for'] = 'new_task'
         elif text == "✔️ Завершить задачу":
-            await self.show_tasks_to_complete(update, context)
+            await self._route(self.show_tasks_to_complete, update, context)
         
         # Обработка настроения
         elif text in ["😎 Отлично", "😊 Хорошо", "😐 Нормально", "😔 Плохо", "😠 Ужасно"]:
@@ -522,9 +1391,9 @@ class MaximoyBot:
                 "😔 Плохо": "sad",
                 "😠 Ужасно": "angry"
             }
-            await self.record_mood(update, context, mood_map[text])
+            await self._route(self.record_mood, update, context, mood_map[text])
         elif text == "📈 Статистика" and update.message.reply_to_message and "настроение" in update.message.reply_to_message.text.lower():
-            await self.show_mood_stats(update, context)
+            await self._route(self.show_mood_stats, update, context)
         
         # Обработка категорий привычек
         elif text in self.categories and context.user_data.get('waiting_for') == 'new_habit_category':
@@ -544,15 +1413,21 @@ class MaximoyBot:
         
         # Обработка ввода данных
         elif context.user_data.get('waiting_for') == 'new_habit_details':
-            await self.process_new_habit(update, context)
+            await self._route(self.process_new_habit, update, context)
         elif context.user_data.get('waiting_for') == 'new_task':
-            await self.process_new_task(update, context)
+            await self._route(self.process_new_task, update, context)
         elif context.user_data.get('waiting_for') == 'complete_task':
-            await self.process_complete_task(update, context)
+            await self._route(self.process_complete_task, update, context)
         elif context.user_data.get('waiting_for') == 'mark_habit':
-            await self.process_mark_habit(update, context)
+            await self._route(self.process_mark_habit, update, context)
         elif context.user_data.get('waiting_for') == 'confirm_reset' and self.is_admin(user_id):
-            await self.process_reset_data(update, context)
+            await self._route(self.process_reset_data, update, context)
+        elif context.user_data.get('waiting_for') == 'find':
+            context.user_data.pop('waiting_for', None)
+            await self._route(self.send_search_results, update, text)
+        elif context.user_data.get('waiting_for') == 'admin_find' and self.is_admin(user_id):
+            context.user_data.pop('waiting_for', None)
+            await self._route(self.send_search_results, update, text, global_search=True)
 
     async def show_habit_categories(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает категории для выбора"""
@@ -614,14 +1489,216 @@ class MaximoyBot:
             parse_mode='MarkdownV2'
         )
 
+    # === МУЛЬТИВЫБОР ===
+    # Префиксы callback_data: mh - отметка привычек, ct - завершение задач
+    SELECT_LIMIT = 40
+
+    def _selection_keyboard(self, prefix, state):
+        """Инлайн-клавиатура с переключателями и кнопкой подтверждения"""
+        rows = []
+        for i, (item_id, label) in enumerate(state["items"], 1):
+            mark = "✅" if item_id in state["selected"] else "⬜"
+            rows.append([InlineKeyboardButton(f"{mark} {i}. {label}", callback_data=f"{prefix}:{item_id}")])
+        rows.append([
+            InlineKeyboardButton("💾 Готово", callback_data=f"{prefix}:done"),
+            InlineKeyboardButton("❌ Отмена", callback_data=f"{prefix}:cancel")
+        ])
+        return InlineKeyboardMarkup(rows)
+
+    async def _show_selection(self, update, context, prefix, items, title, waiting_for):
+        state = {"items": items[:self.SELECT_LIMIT], "selected": []}
+        context.user_data[prefix] = state
+        context.user_data['waiting_for'] = waiting_for
+        await update.message.reply_text(
+            f"{title}\n\n"
+            "Выбери несколько пунктов и нажми «Готово»\n"
+            "Или отправь номера через запятую: `1, 3`",
+            reply_markup=self._selection_keyboard(prefix, state),
+            parse_mode='MarkdownV2'
+        )
+
+    async def show_habits_to_mark(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Мультивыбор привычек для отметки выполнения"""
+        habits = self.storage.get_user_habits(update.effective_user.id)
+        if not habits:
+            await update.message.reply_text(
+                "🎯 *У тебя пока нет привычек*\n\nСоздай первую через «➕ Новая привычка»",
+                parse_mode='MarkdownV2'
+            )
+            return
+        items = [(habit_id, habit["name"]) for habit_id, habit in habits]
+        await self._show_selection(update, context, "mh", items, "✅ *Отметь выполненные привычки*", 'mark_habit')
+
+    async def show_tasks_to_complete(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Мультивыбор задач для завершения"""
+        tasks = self.storage.get_user_tasks(update.effective_user.id)
+        if not tasks:
+            await update.message.reply_text(
+                "✅ *Активных задач нет*\n\nДобавь новую через «🆕 Новая задача»",
+                parse_mode='MarkdownV2'
+            )
+            return
+        items = [(task_id, task["title"]) for task_id, task in tasks]
+        await self._show_selection(update, context, "ct", items, "✔️ *Отметь завершенные задачи*", 'complete_task')
+
+    def _apply_selection(self, prefix, user_id, selected):
+        """Применяет выбор одной пачкой и возвращает текст ответа"""
+        if not selected:
+            return "🤷 *Ничего не выбрано*"
+        
+        if prefix == "mh":
+            done = self.storage.mark_habits_done(selected, user_id)
+            habits = dict(self.storage.get_user_habits(user_id))
+            best = max((habits[habit_id]["streak"] for habit_id in done), default=0)
+            self.storage.unlock_achievements(
+                user_id, [a for a, required in (("streak_3", 3), ("streak_7", 7)) if best >= required]
+            )
+            lines = [f"🔥 {habits[habit_id]['name']} - стрик {habits[habit_id]['streak']}" for habit_id in done]
+            title = f"🎉 *Отмечено привычек: {len(done)}*"
+        else:
+            done = self.storage.complete_tasks(selected, user_id)
+            tasks = self.storage.get_all_tasks()
+            completed = self.storage.get_user_tasks(user_id, completed=True)
+            if len(completed) >= 5:
+                self.storage.unlock_achievements(user_id, ["task_master"])
+            lines = [f"✔️ {tasks[task_id]['title']}" for task_id in done]
+            title = f"🎉 *Завершено задач: {len(done)}*"
+        
+        return title + "\n\n" + "\n".join(escape_markdown(line, version=2) for line in lines)
+
+    def _finish_selection(self, context, prefix, user_id):
+        state = context.user_data.pop(prefix, None) or {"selected": []}
+        context.user_data.pop('waiting_for', None)
+        return self._apply_selection(prefix, user_id, state["selected"])
+
+    async def handle_selection_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Нажатия на инлайн-кнопки мультивыбора"""
+        query = update.callback_query
+        prefix, _, value = (query.data or "").partition(":")
+        state = context.user_data.get(prefix)
+        
+        if prefix not in ("mh", "ct") or state is None:
+            await query.answer("Список устарел, открой его заново")
+            return
+        
+        if value == "cancel":
+            context.user_data.pop(prefix, None)
+            context.user_data.pop('waiting_for', None)
+            await query.answer()
+            await query.edit_message_text("❌ *Отменено*", parse_mode='MarkdownV2')
+        elif value == "done":
+            await query.answer()
+            text = self._finish_selection(context, prefix, update.effective_user.id)
+            await query.edit_message_text(text, parse_mode='MarkdownV2')
+        elif value in dict(state["items"]):
+            if value in state["selected"]:
+                state["selected"].remove(value)
+            else:
+                state["selected"].append(value)
+            await query.answer()
+            await query.edit_message_reply_markup(reply_markup=self._selection_keyboard(prefix, state))
+        else:
+            await query.answer()
+
+    async def _process_selection_text(self, update, context, prefix):
+        """Текстовый ввод номеров вместо нажатия кнопок"""
+        state = context.user_data.get(prefix)
+        if state is None:
+            context.user_data.pop('waiting_for', None)
+            return
+        
+        try:
+            numbers = [int(part) for part in update.message.text.replace(",", " ").split()]
+            selected = [state["items"][n - 1][0] for n in numbers if n >= 1]
+        except (ValueError, IndexError):
+            await update.message.reply_text(
+                "❌ *Не понял номера*\n\nОтправь номера из списка через запятую, например `1, 3`",
+                parse_mode='MarkdownV2'
+            )
+            return
+        
+        state["selected"] = list(dict.fromkeys(selected))
+        text = self._finish_selection(context, prefix, update.effective_user.id)
+        await update.message.reply_text(text, parse_mode='MarkdownV2')
+
+    async def process_mark_habit(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await self._process_selection_text(update, context, "mh")
+
+    async def process_complete_task(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await self._process_selection_text(update, context, "ct")
+
+    # === ПОИСК ===
+    async def find(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /find <запрос>"""
+        if context.args:
+            await self.send_search_results(update, " ".join(context.args))
+        else:
+            await self.ask_search_query(update, context, 'find')
+
+    async def ask_search_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE, mode):
+        scope = "по всем пользователям" if mode == 'admin_find' else "по твоим привычкам и задачам"
+        await update.message.reply_text(
+            f"🔍 *Поиск {scope}*\n\n"
+            "Отправь слово или начало слова, например: `заряд`",
+            parse_mode='MarkdownV2'
+        )
+        context.user_data['waiting_for'] = mode
+
+    async def send_search_results(self, update: Update, query, global_search=False):
+        """Выводит результаты поиска"""
+        if global_search and self.shards > 1:
+            try:
+                results = await self.admin_storage.search(query)
+            except TimeoutError:
+                logger.exception("❌ Global search failed")
+                await update.message.reply_text("❌ *Не все воркеры ответили, попробуй позже*", parse_mode='MarkdownV2')
+                return
+        else:
+            # Сброшенный индекс search перестраивает сам, поэтому вне event loop
+            user_id = None if global_search else update.effective_user.id
+            results = await asyncio.get_running_loop().run_in_executor(None, self.storage.search, query, user_id)
+        
+        if not results:
+            await update.message.reply_text(
+                f"🔍 *Ничего не найдено по запросу* {escape_markdown(query, version=2)}",
+                parse_mode='MarkdownV2'
+            )
+            return
+        
+        lines = []
+        length = 0
+        for data_type, item_id, item in results:
+            if data_type == "habits":
+                line = f"🎯 {item['name']} (🔥 {item['streak']})"
+            else:
+                line = f"{'✔️' if item['completed'] else '📝'} {item['title']}"
+            if item.get("description"):
+                line += f" - {shorten(item['description'], SEARCH_DESCRIPTION_LIMIT)}"
+            if global_search:
+                line += f" [ID {item['user_id']}]"
+            line = escape_markdown(shorten(line, SEARCH_LINE_LIMIT), version=2)
+            # Экранирование удлиняет строку, поэтому считаем уже готовый текст
+            if length + len(line) + 1 > SEARCH_MESSAGE_LIMIT:
+                break
+            lines.append(line)
+            length += len(line) + 1
+        
+        if len(lines) < len(results):
+            lines.append(escape_markdown(f"... и еще {len(results) - len(lines)}", version=2))
+        
+        await update.message.reply_text(
+            f"🔍 *Найдено: {len(results)}*\n\n" + "\n".join(lines),
+            parse_mode='MarkdownV2'
+        )
+
     # ... (остальные методы остаются похожими, но добавляем админ-функции)
 
     async def show_system_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает статистику системы для админа"""
-        stats = self.storage.get_admin_stats()
-        all_users = self.storage.get_all_users()
-        all_habits = self.storage.get_all_habits()
-        all_tasks = self.storage.get_all_tasks()
+        stats = self.admin_storage.get_admin_stats()
+        all_users = self.admin_storage.get_all_users()
+        all_habits = self.admin_storage.get_all_habits()
+        all_tasks = self.admin_storage.get_all_tasks()
         
         # Анализируем активность
         active_today = 0
@@ -634,7 +1711,9 @@ class MaximoyBot:
         text += f"👥 *Пользователи:* {len(all_users)}\n"
         text += f"🎯 *Привычки:* {stats['total_habits']}\n"
         text += f"✅ *Задачи:* {stats['total_tasks']}\n"
-        text += f"🔥 *Активных сегодня:* {active_today}\n\n"
+        text += f"🔥 *Активных сегодня:* {active_today}\n"
+        archive = self.admin_storage.get_archive_stats()
+        text += f"🗄 *Архив:* {archive['tasks']} задач, {archive['mood']} настроений, {archive['progress']} отметок\n\n"
         
         # Топ категорий привычек
         categories = {}
@@ -647,13 +1726,36 @@ class MaximoyBot:
             for cat, count in sorted(categories.items(), key=lambda x: x[1], reverse=True)[:5]:
                 text += f"• {cat}: {count}\n"
         
+        text += self._format_performance_stats()
+        
         await update.message.reply_text(text, parse_mode='MarkdownV2')
 
+    def _format_performance_stats(self):
+        """Секция производительности для статистики системы"""
+        sections = [
+            ("⚙️ *Обработчики:*", "maximoy_handler_seconds"),
+            ("💾 *Хранилище:*", "maximoy_storage_seconds"),
+            ("📡 *Запросы к Telegram:*", "maximoy_telegram_request_seconds"),
+        ]
+        text = ""
+        if self.shards > 1:
+            # Метрики живут в памяти процесса, остальные воркеры видны только через /metrics
+            text += escape_markdown(f"\n📍 Производительность воркера {self.shard_id + 1}/{self.shards}\n", version=2)
+        for title, name in sections:
+            summary = METRICS.summary(name)
+            if not summary:
+                continue
+            text += f"\n{title}\n"
+            top = sorted(summary.items(), key=lambda x: x[1][0], reverse=True)[:self.METRICS_SUMMARY_LIMIT]
+            for label, (count, avg) in top:
+                text += escape_markdown(f"• {label}: {count} шт, {avg * 1000:.1f} мс\n", version=2)
+        return text
+
     async def show_all_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает всех пользователей"""
-        users = self.storage.get_all_users()
-        all_habits = self.storage.get_all_habits()
-        all_tasks = self.storage.get_all_tasks()
+        users = self.admin_storage.get_all_users()
+        all_habits = self.admin_storage.get_all_habits()
+        all_tasks = self.admin_storage.get_all_tasks()
         
         text = "👥 *Все пользователи системы:*\n\n"
         
@@ -672,7 +1774,7 @@ class MaximoyBot:
 
     async def show_habits_analytics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Аналитика привычек"""
-        all_habits = self.storage.get_all_habits()
+        all_habits = self.admin_storage.get_all_habits()
         
         if not all_habits:
             await update.message.reply_text("📊 *Нет данных о привычках*", parse_mode='MarkdownV2')
@@ -721,7 +1823,12 @@ class MaximoyBot:
     async def process_reset_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает сброс данных"""
         if update.message.text == "ДА, УДАЛИТЬ ВСЕ":
-            if self.storage.reset_all_data():
+            try:
+                reset = all(await self._admin_call("reset_all_data"))
+            except TimeoutError:
+                logger.exception("❌ Reset failed")
+                reset = False
+            if reset:
                 await update.message.reply_text(
                     "♻️ *Все данные системы были сброшены\!*\n\n"
                     "База данных очищена\. Начинаем с чистого листа\! 📝",
@@ -737,18 +1844,21 @@ class MaximoyBot:
     async def export_all_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Экспорт всех данных"""
         try:
-            data = self.storage.export_data()
-            # Сохраняем во временный файл
-            filename = f"maximoy_export_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+            # Сохраняем во временный файл: экспорт с архивом пишется потоком, вне event loop
+            with tempfile.TemporaryFile('w+', encoding='utf-8') as f:
+                await asyncio.get_running_loop().run_in_executor(None, self.admin_storage.export_data, f)
+                size = f.tell()
+                f.seek(0)
+                data = f.read(4001)
             
-            # В реальном боте здесь был бы код для сохранения файла
+            # В реальном боте здесь был бы код для отправки файла
             # Для демонстрации отправляем как сообщение (ограничение по длине)
             preview = data[:4000] + "\n\n..." if len(data) > 4000 else data
             
             await update.message.reply_text(
                 f"📤 *Экспорт данных системы*\n\n"
                 f"```json\n{preview}\n```\n\n"
-                f"*Всего данных:* {len(data)} символов",
+                f"*Всего данных:* {size} байт",
                 parse_mode='MarkdownV2'
             )
         except Exception as e:
@@ -768,22 +1878,129 @@ class MaximoyBot:
             parse_mode='MarkdownV2'
         )
 
+    async def show_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Справка по командам"""
+        await update.message.reply_text(
+            "ℹ️ *Помощь Maximoy*\n\n"
+            "🎯 *Привычки* \\- создавай привычки и отмечай выполнение каждый день\n"
+            "✅ *Задачи* \\- добавляй задачи и завершай их пачкой\n"
+            "😊 *Настроение* \\- отмечай настроение и смотри статистику\n"
+            "🏆 *Достижения* \\- награды за регулярность\n"
+            "🔍 *Поиск* \\- поиск по привычкам и задачам\n\n"
+            "*Команды:*\n"
+            "/start \\- главное меню\n"
+            "/find `запрос` \\- поиск\n"
+            "/help \\- эта справка",
+            reply_markup=self.get_main_keyboard(update.effective_user.id),
+            parse_mode='MarkdownV2'
+        )
+
     # ... (остальные методы привычек, задач, настроения остаются похожими)
 
+    def _timed(self, callback):
+        """Оборачивает обработчик замером времени и счетчиком ошибок"""
+        name = callback.__name__
+        
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            await self._wait_ready()
+            token = HANDLER_NAME.set(name)
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                METRICS.inc("maximoy_handler_errors_total", {"handler": HANDLER_NAME.get()})
+                raise
+            finally:
+                METRICS.observe("maximoy_handler_seconds", time.perf_counter() - start, {"handler": HANDLER_NAME.get()})
+                HANDLER_NAME.reset(token)
+        
+        return wrapper
+
+    def _route(self, method, *args, **kwargs):
+        """Вызывает обработчик из handle_message и записывает метрики апдейта на него"""
+        HANDLER_NAME.set(method.__name__)
+        return method(*args, **kwargs)
+
+    async def _wait_ready(self):
+        """Пока идет прогрев, ждет его, отдавая управление event loop"""
+        if not self.storage.ready.is_set():
+            await asyncio.shield(self._warm_up_future)
+
+    async def _post_init(self, application):
+        """Начинаем принимать апдейты сразу, хранилище прогревается в фоне"""
+        loop = asyncio.get_running_loop()
+        self._warm_up_future = loop.run_in_executor(None, self.storage.warm_up)
+        if SNAPSHOT_ENABLED:
+            # spawn: не копируем через fork процесс с потоками и всем кешем
+            self._snapshot_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+        self._retention_task = asyncio.create_task(self._retention_loop())
+
+    async def _post_shutdown(self, application):
+        self._retention_task.cancel()
+        if SNAPSHOT_ENABLED:
+            self._snapshot_task.cancel()
+            self._snapshot_pool.shutdown()
+            self.storage.save_snapshot()
+
+    async def _snapshot_loop(self):
+        """Периодически сохраняет снапшоты изменившихся файлов, чтобы рестарт после падения тоже был быстрым.
+        Разбор и pickle идут в отдельном процессе, event loop только передает текст JSON"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            if not self.storage.ready.is_set():
+                continue
+            for job in self.storage.take_snapshot_jobs():
+                try:
+                    await loop.run_in_executor(self._snapshot_pool, write_snapshot_file, *job)
+                except Exception:
+                    logger.exception(f"❌ Snapshot {job[0]} failed")
+
+    async def _retention_loop(self):
+        """Периодически переносит старые записи в архив"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.storage.ready.wait)
+        while True:
+            try:
+                moved = await loop.run_in_executor(None, self.storage.apply_retention)
+                if any(moved.values()):
+                    logger.info(f"🗄 Archived: {moved}")
+            except Exception:
+                # Одна битая запись не должна останавливать ретеншн навсегда
+                METRICS.inc("maximoy_retention_errors_total")
+                logger.exception("❌ Retention run failed")
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    def build_application(self):
+        """Создает приложение и регистрирует обработчики"""
+        application = Application.builder().token(self.token).request(
+            InstrumentedRequest(connection_pool_size=256)
+        ).post_init(self._post_init).post_shutdown(self._post_shutdown).build()
+        
+        # Команды
+        application.add_handler(CommandHandler("start", self._timed(self.start)))
+        application.add_handler(CommandHandler("help", self._timed(self.show_help)))
+        application.add_handler(CommandHandler("admin", self._timed(self.show_admin_panel)))
+        application.add_handler(CommandHandler("find", self._timed(self.find)))
+        
+        # Обработка текстовых сообщений (кнопки)
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self._timed(self.handle_message)))
+        
+        # Инлайн-кнопки мультивыбора
+        application.add_handler(CallbackQueryHandler(self._timed(self.handle_selection_callback), pattern=r"^(mh|ct):"))
+        
+        return application
+
     def run(self):
         if not self.token:
             logger.error("❌ TELEGRAM_BOT_TOKEN not found!")
             return
         
-        application = Application.builder().token(self.token).build()
-        
-        # Команды
-        application.add_handler(CommandHandler("start", self.start))
-        application.add_handler(CommandHandler("help", self.show_help))
-        application.add_handler(CommandHandler("admin", self.show_admin_panel))
-        
-        # Обработка текстовых сообщений (кнопки)
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        application = self.build_application()
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
         
         logger.info("🚀 Starting Maximoy Bot...")
         application.run_polling()
@@ -799,6 +2016,259 @@ class MaximoyBot:
         else:
             await update.message.reply_text("❌ *У тебя нет доступа к этой команде*", parse_mode='MarkdownV2')
 
+# === МАСШТАБИРОВАНИЕ ===
+def reshard_storage(shards):
+    """Переносит данные пользователей в раскладку на shards воркеров.
+    Запускается при старте, до воркеров, поэтому ни с кем не конкурирует.
+    Новая раскладка собирается в отдельной папке, старые данные удаляются только
+    после записи layout.json, поэтому сбой на любом шаге не теряет и не дублирует записи"""
+    layout = read_layout()
+    if "previous" in layout:
+        # Прошлый перенос упал после фиксации - доводим его до конца
+        _install_reshard(layout["previous"], layout["shards"])
+    current = layout["shards"]
+    if current == shards:
+        return False
+    
+    logger.info(f"🔀 Resharding storage: {current} -> {shards} workers")
+    staging = os.path.join(DATA_DIR, RESHARD_STAGING)
+    # Остатки упавшего до фиксации переноса: старые данные он не трогал, начинаем заново
+    shutil.rmtree(staging, ignore_errors=True)
+    old = [MaximoyStorage(shard_data_dir(i, current)) for i in range(current)]
+    new = [MaximoyStorage(os.path.join(staging, f"shard_{i}")) for i in range(shards)]
+    
+    # Записи с user_id внутри
+    counts = {}
+    for data_type in ("habits", "tasks", "mood"):
+        parts = [{} for _ in range(shards)]
+        for storage in old:
+            for item_id, item in storage._load_data(data_type).items():
+                part = parts[shard_for_user(item["user_id"], shards)]
+                # ID генерируются в шардах независимо, при слиянии они могут совпасть
+                while item_id in part and part[item_id] != item:
+                    item_id = str(int(item_id) + 1)
+                part[item_id] = item
+        for storage, part in zip(new, parts):
+            storage._save_data(data_type, part)
+        counts[data_type] = [len(part) for part in parts]
+    
+    # Записи с user_id в ключе
+    for data_type in ("achievements", "users"):
+        parts = [{} for _ in range(shards)]
+        for storage in old:
+            for user_id, value in storage._load_data(data_type).items():
+                part = parts[shard_for_user(int(user_id), shards)]
+                if isinstance(value, dict):
+                    part.setdefault(user_id, {}).update(value)
+                else:
+                    part[user_id] = value
+        for storage, part in zip(new, parts):
+            storage._save_data(data_type, part)
+    
+    # Счетчики: каждому шарду его записи, остаток (например, архивные задачи) - нулевому
+    old_stats = [storage.get_admin_stats() for storage in old]
+    last_resets = [stats["last_reset"] for stats in old_stats if stats.get("last_reset")]
+    totals = {key: sum(stats.get(key, 0) for stats in old_stats) for key in ("total_users", "total_habits", "total_tasks")}
+    for i, storage in enumerate(new):
+        stats = {
+            "total_users": totals["total_users"] if i == 0 else 0,
+            "total_habits": counts["habits"][i],
+            "total_tasks": counts["tasks"][i],
+            "last_reset": max(last_resets) if last_resets else None
+        }
+        if i == 0:
+            stats["total_habits"] += max(totals["total_habits"] - sum(counts["habits"]), 0)
+            stats["total_tasks"] += max(totals["total_tasks"] - sum(counts["tasks"]), 0)
+        storage._save_data("admin_stats", stats)
+    
+    # Архив. Папка архива есть у каждого нового шарда, даже пустая: при установке
+    # она заменяет старый архив целиком
+    for archive_type in ARCHIVE_TYPES:
+        parts = [[] for _ in range(shards)]
+        for storage in old:
+            for record in storage.iter_archive(archive_type):
+                parts[shard_for_user(record["user_id"], shards)].append(record)
+        for storage, part in zip(new, parts):
+            if part:
+                storage._write_segment(archive_type, part)
+    for storage in new:
+        os.makedirs(storage.archive_dir, exist_ok=True)
+    
+    # Фиксация: с этого момента перенос доводится до конца, даже если процесс упадет
+    write_layout({"shards": shards, "previous": current})
+    _install_reshard(current, shards)
+    
+    logger.info(f"🔀 Resharding done: {sum(counts['habits'])} habits, {sum(counts['tasks'])} tasks")
+    return True
+
+
+def _install_reshard(previous, shards):
+    """Ставит собранную раскладку на место и удаляет старую. Повторный запуск после сбоя безопасен"""
+    staging = os.path.join(DATA_DIR, RESHARD_STAGING)
+    targets = [shard_data_dir(i, shards) for i in range(shards)]
+    for i, target in enumerate(targets):
+        source = os.path.join(staging, f"shard_{i}")
+        if not os.path.isdir(source):
+            # Этот шард уже перенесен
+            continue
+        os.makedirs(target, exist_ok=True)
+        # Снапшоты старых файлов больше не нужны
+        for name in os.listdir(target):
+            if name.startswith("snapshot_"):
+                os.remove(os.path.join(target, name))
+        staged_archive = os.path.join(source, "archive")
+        if os.path.isdir(staged_archive):
+            shutil.rmtree(os.path.join(target, "archive"), ignore_errors=True)
+            os.rename(staged_archive, os.path.join(target, "archive"))
+        for name in os.listdir(source):
+            os.replace(os.path.join(source, name), os.path.join(target, name))
+        os.rmdir(source)
+    
+    # Старые папки, которые не вошли в новую раскладку
+    for i in range(previous):
+        old_dir = shard_data_dir(i, previous)
+        if old_dir in targets:
+            continue
+        if old_dir == DATA_DIR:
+            for name in os.listdir(DATA_DIR):
+                if (name.endswith(".json") and name[:-5] in DATA_TYPES) or name.startswith("snapshot_"):
+                    os.remove(os.path.join(DATA_DIR, name))
+            shutil.rmtree(os.path.join(DATA_DIR, "archive"), ignore_errors=True)
+        else:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    
+    shutil.rmtree(staging, ignore_errors=True)
+    write_layout({"shards": shards})
+
+
+async def _worker_loop(application, storage, shard_id, queue, reply_queues):
+    """Обрабатывает апдейты и запросы админа из очереди строго по порядку"""
+    loop = asyncio.get_running_loop()
+    async with application:
+        # run_polling здесь не используется, поэтому хуки вызываем сами
+        await application.post_init(application)
+        while True:
+            payload = await loop.run_in_executor(None, queue.get)
+            if payload is None:
+                break
+            if isinstance(payload, dict):
+                # Запрос от админского воркера к нашему шарду
+                if not storage.ready.is_set():
+                    await loop.run_in_executor(None, storage.ready.wait)
+                if payload["rpc"] in RPC_METHODS:
+                    # Вне event loop: поиск может перестраивать сброшенный индекс
+                    method = functools.partial(getattr(storage, payload["rpc"]), *payload["args"])
+                    result = await loop.run_in_executor(None, method)
+                else:
+                    logger.error(f"❌ Unknown RPC method {payload['rpc']}")
+                    result = None
+                reply_queues[payload["reply_to"]].put(
+                    {"request_id": payload["request_id"], "shard_id": shard_id, "result": result}
+                )
+                continue
+            update = Update.de_json(json.loads(payload), application.bot)
+            await application.process_update(update)
+        await application.post_shutdown(application)
+
+
+def worker_main(shard_id, shards, queues, reply_queues):
+    """Точка входа процесса-воркера: владеет своим шардом и состоянием диалогов"""
+    bot = MaximoyBot(shard_id, shards, queues, reply_queues)
+    application = bot.build_application()
+    if METRICS_PORT:
+        # Каждый воркер отдает свои метрики на следующем порту после фронта
+        start_metrics_server(METRICS_PORT + 1 + shard_id)
+    logger.info(f"🧩 Worker {shard_id}/{shards} started")
+    try:
+        asyncio.run(_worker_loop(application, bot.storage, shard_id, queues[shard_id], reply_queues))
+    except KeyboardInterrupt:
+        pass
+    logger.info(f"🧩 Worker {shard_id}/{shards} stopped")
+
+
+def run_cluster(token, shards):
+    """Фронт-процесс: получает апдейты и раскладывает их по воркерам по user_id"""
+    # spawn, а не fork: фронт к этому моменту уже запустил потоки (метрики, логирование),
+    # и их блокировки, скопированные в воркер посреди захвата, остались бы занятыми навсегда
+    mp_context = multiprocessing.get_context("spawn")
+    queues = [mp_context.Queue() for _ in range(shards)]
+    reply_queues = [mp_context.Queue() for _ in range(shards)]
+    
+    def start_worker(shard_id):
+        # Не daemon: воркеру нужен свой процесс для снапшотов
+        worker = mp_context.Process(target=worker_main, args=(shard_id, shards, queues, reply_queues))
+        worker.start()
+        return worker
+    
+    workers = [start_worker(i) for i in range(shards)]
+    restarts = 0
+    failed = False
+    
+    async def supervise(application):
+        """Перезапускает упавших воркеров; апдейты ждут их в очереди"""
+        nonlocal restarts, failed
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for i, worker in enumerate(workers):
+                if worker.is_alive():
+                    continue
+                restarts += 1
+                METRICS.inc("maximoy_worker_restarts_total", {"shard": i})
+                if restarts > WORKER_MAX_RESTARTS:
+                    # Падаем целиком, чтобы сработал restartPolicy на Railway
+                    logger.error(f"💀 Worker {i} died (exit code {worker.exitcode}), restart limit reached")
+                    failed = True
+                    application.stop_running()
+                    return
+                logger.error(f"💀 Worker {i} died (exit code {worker.exitcode}), restarting")
+                workers[i] = start_worker(i)
+    
+    async def start_supervisor(application):
+        application.bot_data["supervisor"] = asyncio.create_task(supervise(application))
+    
+    async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id if update.effective_user else None
+        shard_id = shard_for_user(user_id, shards)
+        queues[shard_id].put(update.to_json())
+        METRICS.inc("maximoy_routed_updates_total", {"shard": shard_id})
+    
+    application = Application.builder().token(token).post_init(start_supervisor).build()
+    application.add_handler(TypeHandler(Update, route_update))
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    
+    logger.info(f"🚀 Starting Maximoy cluster with {shards} workers...")
+    try:
+        application.run_polling()
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+    
+    if failed:
+        sys.exit(1)
+
+def main():
+    """Запуск: сначала раскладка данных и режим, потом хранилище.
+    MaximoyBot создается только в режиме одного процесса - его хранилище при создании
+    заводит пустые файлы в своей папке и не должно опережать перенос данных"""
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token:
+        logger.error("❌ TELEGRAM_BOT_TOKEN not found!")
+        return
+    
+    # Число воркеров могло измениться с прошлого запуска
+    reshard_storage(WORKERS)
+    
+    if WORKERS > 1:
+        run_cluster(token, WORKERS)
+        return
+    
+    MaximoyBot().run()
+
+
 if __name__ == "__main__":
-    bot = MaximoyBot()
-    bot.run()
+    main()
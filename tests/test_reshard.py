@@ -0,0 +1,142 @@
+"""Перенос данных между раскладками воркеров: ни одна запись не теряется и не дублируется"""
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import bot as maximoy
+
+USERS = range(1, 11)
+
+
+class ReshardStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix="maximoy_test_")
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+        patcher = mock.patch.object(maximoy, "DATA_DIR", self.data_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        fill_storage(maximoy.MaximoyStorage(self.data_dir))
+        self.expected = collect(1)
+
+    def assert_layout(self, shards):
+        self.assertEqual(maximoy.read_layout(), {"shards": shards})
+        self.assertEqual(collect(shards), self.expected)
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, maximoy.RESHARD_STAGING)))
+        for i in range(shards):
+            storage = maximoy.MaximoyStorage(maximoy.shard_data_dir(i, shards))
+            for data_type in ("habits", "tasks", "mood"):
+                for item in storage._load_data(data_type).values():
+                    self.assertEqual(maximoy.shard_for_user(item["user_id"], shards), i)
+
+    def test_round_trip(self):
+        for shards in (3, 2, 1):
+            self.assertTrue(maximoy.reshard_storage(shards))
+            self.assert_layout(shards)
+        self.assertFalse(maximoy.reshard_storage(1))
+        self.assertEqual(sorted(os.listdir(self.data_dir)), sorted(
+            [f"{data_type}.json" for data_type in maximoy.DATA_TYPES] + ["archive", "layout.json"]
+        ))
+
+    def test_crash_before_commit_is_redone_from_old_layout(self):
+        with mock.patch.object(maximoy, "write_layout", side_effect=RuntimeError("crash")):
+            self.assertRaises(RuntimeError, maximoy.reshard_storage, 3)
+        self.assertEqual(maximoy.read_layout(), {"shards": 1})
+        self.assertEqual(collect(1), self.expected)
+
+        self.assertTrue(maximoy.reshard_storage(3))
+        self.assert_layout(3)
+
+    def test_crash_after_commit_is_finished_on_next_start(self):
+        self.assertTrue(maximoy.reshard_storage(2))
+        with mock.patch.object(maximoy, "_install_reshard", side_effect=RuntimeError("crash")):
+            self.assertRaises(RuntimeError, maximoy.reshard_storage, 3)
+
+        self.assertFalse(maximoy.reshard_storage(3))
+        self.assert_layout(3)
+
+    def test_crash_during_install_is_finished_on_next_start(self):
+        self.assertTrue(maximoy.reshard_storage(2))
+        rmdir = os.rmdir
+        staged_shard = os.path.join(self.data_dir, maximoy.RESHARD_STAGING, "shard_1")
+
+        def crash_on_second_shard(path, *args, **kwargs):
+            # Первый шард уже на месте, второй перенесен, но его папка в staging осталась
+            if path == staged_shard:
+                raise OSError("crash")
+            rmdir(path, *args, **kwargs)
+
+        with mock.patch.object(maximoy.os, "rmdir", crash_on_second_shard):
+            self.assertRaises(OSError, maximoy.reshard_storage, 3)
+
+        self.assertFalse(maximoy.reshard_storage(3))
+        self.assert_layout(3)
+
+
+def fill_storage(storage):
+    """Привычки, задачи, настроение, достижения и архив для нескольких пользователей"""
+    now = datetime.datetime(2024, 5, 1)
+    habits, tasks, mood, achievements, archive = {}, {}, {}, {}, {"tasks": [], "mood": [], "progress": []}
+    next_id = 1714521600000
+    for user_id in USERS:
+        for n in range(3):
+            next_id += 1
+            habits[str(next_id)] = {
+                "user_id": user_id, "name": f"Привычка {n}", "description": "", "category": "Спорт",
+                "difficulty": "medium", "streak": n, "best_streak": n, "total_completed": n,
+                "created_date": now.isoformat(),
+                "progress": {f"2024-04-{day:02d}": {"completed": True, "timestamp": now.isoformat()} for day in range(1, n + 2)},
+            }
+            archive["progress"].append({
+                "habit_id": str(next_id), "user_id": user_id, "date": "2024-01-01",
+                "completed": True, "timestamp": "2024-01-01T00:00:00",
+            })
+            next_id += 1
+            tasks[str(next_id)] = {
+                "user_id": user_id, "title": f"Задача {n}", "description": "", "priority": "low",
+                "due_date": None, "completed": n == 0, "created_date": now.isoformat(),
+            }
+            next_id += 1
+            mood[str(next_id)] = {"user_id": user_id, "mood": "happy", "notes": "", "timestamp": now.isoformat()}
+        achievements[str(user_id)] = {"first_habit": {"unlocked_at": now.isoformat()}}
+        archive["tasks"].append({"id": f"old-{user_id}", "user_id": user_id, "title": "Старая", "completed": True})
+        archive["mood"].append({"id": f"old-{user_id}", "user_id": user_id, "mood": "sad", "timestamp": "2023-01-01T00:00:00"})
+
+    storage._save_data("habits", habits)
+    storage._save_data("tasks", tasks)
+    storage._save_data("mood", mood)
+    storage._save_data("achievements", achievements)
+    storage._save_data("admin_stats", {
+        "total_users": len(USERS), "total_habits": len(habits), "total_tasks": len(tasks), "last_reset": None,
+    })
+    for archive_type, records in archive.items():
+        # Два сегмента на тип, как после двух прогонов ретеншна
+        storage._write_segment(archive_type, records[:5])
+        storage._write_segment(archive_type, records[5:])
+
+
+def collect(shards):
+    """Все данные раскладки без привязки к шардам. ID записей при слиянии могут смениться,
+    поэтому записи сравниваются по содержимому, с учетом повторов"""
+    storages = [maximoy.MaximoyStorage(maximoy.shard_data_dir(i, shards)) for i in range(shards)]
+    result = {}
+    for data_type in ("habits", "tasks", "mood"):
+        result[data_type] = sorted(
+            json.dumps(item, sort_keys=True) for storage in storages for item in storage._load_data(data_type).values()
+        )
+    result["achievements"] = {}
+    for storage in storages:
+        result["achievements"].update(storage._load_data("achievements"))
+    for archive_type in maximoy.ARCHIVE_TYPES:
+        result[f"archive_{archive_type}"] = sorted(
+            json.dumps(record, sort_keys=True) for storage in storages for record in storage.iter_archive(archive_type)
+        )
+    result["totals"] = maximoy.ShardedStorage(shards).get_admin_stats() if shards > 1 else storages[0].get_admin_stats()
+    return result
+
+
+if __name__ == "__main__":
+    unittest.main()